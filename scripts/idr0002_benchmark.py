@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#
+# Copyright (c) 2026 University of Dundee.
+#
+#   Redistribution and use in source and binary forms, with or without modification, 
+#   are permitted provided that the following conditions are met:
+# 
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#   Redistributions in binary form must reproduce the above copyright notice, 
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#   ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+#   OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+#   IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, 
+#   INCIDENTAL, SPECIAL, EXEMPLARY OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+#   PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#   HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#   (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+#   OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Version: 1.0
+#
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy
+import zarr
+
+# Code of the analysis that is measured
+import idr0002_save
+import idr0002_idr_zarr
+from idr0002_save import analyze, load_pipeline, prepare_pipeline
+from idr0002_save import save_results
+from idr0002_idr_zarr import cache_info, load_dask_array_from_s3
+from idr0002_idr_zarr import load_plate_store
+
+
+# Fake-server
+# Stand-in for BlitzGateway serving a synthetic plate.
+# Each call to the server waits for latency seconds.
+class FakeObject(object):
+
+    def __init__(self, conn, object_id, name):
+        self._conn = conn
+        self.object_id = object_id
+        self.name = name
+
+    def getId(self):
+        return self.object_id
+
+    def getName(self):
+        return self.name
+
+
+class FakeQueryService(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def projection(self, query, params, ctx=None):
+        # Rows of the plate index query, one per Channel of each Image
+        self.conn.wait()
+        rows = []
+        for i in range(self.conn.well_count):
+            row, column = divmod(i, self.conn.columns)
+            for c in range(self.conn.size_c):
+                rows.append([i + 1, row, column, None,
+                             i + 1, 'image-%s' % (i + 1), i + 1,
+                             self.conn.size_x, self.conn.size_y, 1,
+                             self.conn.size_c, 1, 'uint16', 'channel-%s' % c])
+        return rows
+
+
+class FakeRawPixelsStore(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def setPixelsId(self, pixels_id, bypass, ctx=None):
+        self.conn.wait()
+
+    def getHypercube(self, offset, size, step, ctx=None):
+        self.conn.wait()
+        self.conn.bytes_sent += self.conn.planes.nbytes
+        return self.conn.planes.astype('>u2').tobytes()
+
+    def close(self):
+        pass
+
+
+class FakeUpdateService(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def saveArray(self, objects, ctx=None):
+        self.conn.wait()
+        return objects
+
+
+class FakeConnection(object):
+    SERVICE_OPTS = None
+
+    def __init__(self, well_count, size_x, size_y, size_c, latency,
+                 columns=12):
+        self.well_count = well_count
+        self.columns = columns
+        self.size_x = size_x
+        self.size_y = size_y
+        self.size_c = size_c
+        self.latency = latency
+        self.bytes_sent = 0
+        self.planes = synthetic_planes(size_c, size_y, size_x)
+
+    def wait(self):
+        time.sleep(self.latency)
+
+    def getObject(self, object_type, object_id):
+        self.wait()
+        return FakeObject(self, int(object_id), 'plate-%s' % object_id)
+
+    def getQueryService(self):
+        return FakeQueryService(self)
+
+    def createRawPixelsStore(self):
+        self.wait()
+        return FakeRawPixelsStore(self)
+
+    def createOriginalFileFromLocalFile(self, path, mimetype=None):
+        self.wait()
+        return FakeObject(self, 1, os.path.basename(path))
+
+    def getUpdateService(self):
+        return FakeUpdateService(self)
+
+
+def synthetic_planes(size_c, size_y, size_x, count=50, seed=0):
+    # Bright round nuclei on a noisy background, the same for all channels
+    random = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:size_y, 0:size_x]
+    plane = random.normal(100, 10, (size_y, size_x))
+    for cy, cx, r in zip(random.integers(0, size_y, count),
+                         random.integers(0, size_x, count),
+                         random.integers(5, 15, count)):
+        plane[(y - cy) ** 2 + (x - cx) ** 2 < r ** 2] += 2000
+    planes = numpy.stack([plane] * size_c)
+    return numpy.clip(planes, 0, 65535).astype(numpy.uint16)
+
+
+def create_zarr_plate(path, well_count, planes, columns=12):
+    # Local OME-Zarr plate, one (t, c, z, y, x) image per Well
+    root = zarr.open_group(path, mode='w')
+    rows = (well_count + columns - 1) // columns
+    wells = []
+    for i in range(well_count):
+        row, column = divmod(i, columns)
+        well_path = 'r%s/c%s' % (row, column)
+        wells.append({'path': well_path, 'rowIndex': row,
+                      'columnIndex': column})
+        well = root.require_group(well_path)
+        well.attrs['well'] = {'images': [{'path': '0'}]}
+        well.create_dataset('0/0', data=planes[None, :, None],
+                            chunks=(1, 1, 1) + planes.shape[1:])
+    root.attrs['plate'] = {
+        'rows': [{'name': 'r%s' % row} for row in range(rows)],
+        'columns': [{'name': 'c%s' % column} for column in range(columns)],
+        'wells': wells,
+    }
+
+
+# Benchmark
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summary(durations):
+    durations = numpy.array(durations) * 1000
+    return 'p50 %8.1f ms  p95 %8.1f ms' % (numpy.percentile(durations, 50),
+                                           numpy.percentile(durations, 95))
+
+
+def read_events(path):
+    # Durations of the events emitted by the analysis, by stage
+    durations = {}
+    with open(path) as f:
+        for line in f:
+            event = json.loads(line)
+            stage = event['stage']
+            if stage == 'module':
+                stage = 'module %s' % event['module']
+            durations.setdefault(stage, []).append(event['duration'])
+    return durations
+
+
+def benchmark_zarr(plate, planes, cache_directory):
+    # Wells read through the LRU and the disk caches of the Zarr analysis
+    zarr_path = tempfile.mkdtemp()
+    create_zarr_plate(zarr_path, plate._conn.well_count, planes)
+    load_plate_store(plate.getId(), cache_directory=cache_directory,
+                     store=zarr.DirectoryStore(zarr_path))
+    start = time.perf_counter()
+    plate_index = idr0002_idr_zarr.load_plate_index(plate)
+    durations = {'zarr_index': [time.perf_counter() - start],
+                 'zarr_fetch': []}
+    for zarr_path in plate_index.values():
+        start = time.perf_counter()
+        data = load_dask_array_from_s3(plate.getId(), zarr_path)
+        data[0, :, 0, :, :].compute()
+        durations['zarr_fetch'].append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark(pipeline_path, image_names, well_count, size, latency):
+    # Run in its own process, so the peak RSS is the one of this pipeline
+    conn = FakeConnection(well_count, size, size, len(image_names), latency)
+    # Stages are timed by the instrumentation of the analysis
+    idr0002_save.events_path = tempfile.mkstemp(suffix='.jsonl')[1]
+
+    start = time.perf_counter()
+    pipeline = prepare_pipeline(load_pipeline(pipeline_path), image_names)
+    load_time = time.perf_counter() - start
+
+    plate = conn.getObject("Plate", 1)
+    start = time.perf_counter()
+    files = analyze(plate, pipeline, limit=well_count)
+    total = time.perf_counter() - start
+    # Pipelines without Nuclei write no Nuclei.csv
+    files = [f for f in files if os.path.exists(f)]
+    if files:
+        save_results(conn, files, plate)
+
+    durations = read_events(idr0002_save.events_path)
+    durations.update(benchmark_zarr(plate, conn.planes, tempfile.mkdtemp()))
+
+    print(os.path.basename(pipeline_path))
+    print('  load_pipeline     %8.1f ms' % (load_time * 1000))
+    for stage, stage_durations in sorted(durations.items()):
+        print('  %-28s %s' % (stage, summary(stage_durations)))
+    print('  throughput   %8.2f images/s' % (well_count / total))
+    print('  transferred  %8.1f MB' % (conn.bytes_sent / 2**20))
+    print('  zarr cache   %s' % cache_info(plate.getId()))
+    print('  peak RSS     %8.1f MB' % peak_rss_mb())
+
+
+# main
+def main():
+    well_count = int(input("Number of wells [20]: ") or '20')
+    size = int(input("Size of the planes [512]: ") or '512')
+    latency = float(input("Latency of the server in ms [20]: ") or '20')
+    # Pipelines and the names of the channels they expect
+    pipelines = [
+        ("../notebooks/pipelines/ExamplePercentPositive.cppipe",
+         ('OrigBlue', 'OrigGreen')),
+        ("../notebooks/pipelines/ExampleFly.cppipe",
+         ('OrigBlue', 'OrigGreen', 'OrigRed')),
+    ]
+    # One process per pipeline, "spawn" so it starts with an empty memory
+    context = multiprocessing.get_context("spawn")
+    for pipeline_path, image_names in pipelines:
+        process = context.Process(target=benchmark, args=(
+            pipeline_path, image_names, well_count, size, latency / 1000))
+        process.start()
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
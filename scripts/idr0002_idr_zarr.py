@@ -24,10 +24,15 @@
 #
 # Version: 1.0
 #
+import hashlib
 import os
 import tempfile
+import threading
+import time
 import warnings
 
+from collections.abc import MutableMapping
+
 # Import OMERO Python BlitzGateway
 from omero.gateway import BlitzGateway
 
@@ -44,8 +49,11 @@ import cellprofiler_core.pipeline as cpp
 # module used to inject OMERO image planes into Cell Profiler Pipeline
 from cellprofiler_core.modules.injectimage import InjectImage
 
+import numpy
+import pandas
 import zarr
 import s3fs
+import dask
 import dask.array as da
 
 
@@ -79,66 +87,397 @@ def load_pipeline(pipeline_path):
     return pipeline
 
 
+# Prepare-pipeline
+class InjectPlane(InjectImage):
+    # InjectImage module whose plane is replaced for each Image
+    def __init__(self, image_name, channel):
+        super(InjectPlane, self).__init__(image_name, None)
+        self.channel = channel
+
+    def set_plane(self, plane):
+        self._InjectImage__image = plane
+
+
+def prepare_pipeline(pipeline, image_names=('OrigBlue', 'OrigGreen')):
+    # Add the modules injecting the planes once instead of copying
+    # the pipeline for each Image. Names of the channels expected
+    # in the pipeline, in the order of the Channels.
+    if any(isinstance(m, InjectPlane) for m in pipeline.modules()):
+        return pipeline
+    for c, image_name in enumerate(image_names):
+        inject_plane_module = InjectPlane(image_name, c)
+        inject_plane_module.set_module_num(1)
+        pipeline.add_module(inject_plane_module)
+    return pipeline
+
+
+def set_planes(pipeline, planes):
+    # Replace the planes injected in the prepared pipeline
+    for module in pipeline.modules():
+        if isinstance(module, InjectPlane):
+            module.set_plane(planes[module.channel])
+
+
 # Analyze-data
-def analyze(plate, pipeline):
+def analyze(plate, pipeline, cache_directory=None, resolution='0',
+            all_fields=False):
     warnings.filterwarnings('ignore')
     print("analyzing...")
-    # Set Cell Output Directory
-    new_output_directory = os.path.normcase(tempfile.mkdtemp())
-    cpprefs.set_default_output_directory(new_output_directory)
-
+    prepare_pipeline(pipeline)
     files = list()
     wells = list(plate.listChildren())
     wells = wells[0:5]  # use the first 5 wells
     plate_id = plate.getId()
-    for count, well in enumerate(wells):
-        # Load a single Image per Well
-        image = well.getImage(0)
-        print(image.getName())
-        data = load_dask_array_from_s3(plate_id, (well.row+1)*(well.column+1)-1)
-        size_c = image.getSizeC()
-        # For each Image in OMERO, we copy pipeline and inject image modules
-        pipeline_copy = pipeline.copy()
-        # Inject image for each Channel (pipeline only handles 2 channels)
-        for c in range(0, size_c):
-            plane = data[0, c, 0, :, :]
-            image_name = image.getName()
-            # Name of the channel expected in the pipeline
-            if c == 0:
-                image_name = 'OrigBlue'
-            if c == 1:
-                image_name = 'OrigGreen'
-            inject_image_module = InjectImage(image_name, plane)
-            inject_image_module.set_module_num(1)
-            pipeline_copy.add_module(inject_image_module)
-        pipeline_copy.run()
-
-        # Results obtained as CSV from Cell Profiler
-        path = new_output_directory + '/Nuclei.csv'
-        files.append(path)
+    load_plate_store(plate_id, cache_directory=cache_directory)
+    plate_index = load_plate_index(plate)
+    for well in wells:
+        # All the fields of the Well, or only the first one
+        fields = well.countWellSample() if all_fields else 1
+        for field in range(fields):
+            if (well.row, well.column, field) not in plate_index:
+                continue
+            image = well.getImage(field)
+            print(image.getName())
+            zarr_path = plate_index[(well.row, well.column, field)]
+            data = load_dask_array_from_s3(plate_id, zarr_path, resolution)
+            # Channels of the first timepoint and z-section
+            planes = data[0, :, 0, :, :]
+            # Set Cell Output Directory, one per field so results are kept
+            new_output_directory = os.path.normcase(tempfile.mkdtemp())
+            cpprefs.set_default_output_directory(new_output_directory)
+            # For each Image in OMERO, we only replace the injected planes
+            set_planes(pipeline, planes)
+            pipeline.run()
+
+            # Results obtained as CSV from Cell Profiler
+            path = new_output_directory + '/Nuclei.csv'
+            files.append(path)
+    print("cache: %s" % cache_info(plate_id))
     print("analysis done")
     return files
 
 
 # Load-data from S3
-def load_dask_array_from_s3(plate_id, index, resolution='0'):
-    cache_size_mb = 2048
-    cfg = {
-        'anon': True,
-        'client_kwargs': {
-            'endpoint_url': 'https://minio-dev.openmicroscopy.org/',
-        },
-        'root': 'idr/zarr/v0.1-extra/plate-%s.zarr/%s/%s' % (plate_id, index,
-                                                             resolution)
-    }
-    s3 = s3fs.S3FileSystem(
-        anon=cfg['anon'],
-        client_kwargs=cfg['client_kwargs'],
-    )
-    store = s3fs.S3Map(root=cfg['root'], s3=s3, check=False)
-    cached_store = zarr.LRUStoreCache(store, max_size=(cache_size_mb * 2**20))
+ENDPOINT_URL = 'https://minio-dev.openmicroscopy.org/'
+# One store and one index per plate, shared by all the Wells of the plate
+plate_stores = {}
+plate_indexes = {}
+
+
+class DiskStoreCache(MutableMapping):
+    # Keep a copy of the chunks read from the store in a local directory,
+    # so they are not downloaded again when the analysis is re-run.
+    # The least recently used chunks are removed above max_size bytes.
+    # Chunks are read by several threads when run by Dask.
+
+    def __init__(self, store, root, directory, max_size):
+        self.store = store
+        self.root = root
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.current_size = sum(entry.stat().st_size
+                                for entry in os.scandir(directory)
+                                if entry.is_file())
+
+    def __getstate__(self):
+        # Sent to the processes running the tasks, without the lock
+        return (self.store, self.root, self.directory, self.max_size,
+                self.current_size)
+
+    def __setstate__(self, state):
+        (self.store, self.root, self.directory, self.max_size,
+         self.current_size) = state
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        # Name of the file is the hash of the store and of the chunk key
+        name = '%s/%s' % (self.root, key)
+        return os.path.join(self.directory,
+                            hashlib.sha1(name.encode()).hexdigest())
+
+    def __getitem__(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            # Mark the chunk as recently used
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            pass
+        value = self.store[key]
+        self._write(path, value)
+        return value
+
+    def _write(self, path, value):
+        # A temporary file per writer, so two threads writing
+        # the same chunk do not write to the same file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        with self.lock:
+            # The same chunk may have been written by another thread
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+            self.current_size += len(value) - replaced_size
+            if self.current_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry))
+            except FileNotFoundError:
+                # Replaced or removed since listed
+                continue
+        entries.sort(key=lambda item: item[0])
+        for mtime, entry in entries:
+            if self.current_size <= self.max_size:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.current_size -= size
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key)) or key in self.store
+
+    def __setitem__(self, key, value):
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+def load_plate_store(plate_id, cache_size_mb=2048, cache_directory=None,
+                     disk_cache_size_mb=20480, store=None):
+    # The S3 connections and the cache of chunks are created once
+    # and reused for each Well instead of being recreated for each Well.
+    # store replaces the S3 store, e.g. with a local copy of the plate
+    if plate_id not in plate_stores:
+        root = 'idr/zarr/v0.1-extra/plate-%s.zarr' % plate_id
+        if store is None:
+            s3 = s3fs.S3FileSystem(
+                anon=True,
+                client_kwargs={'endpoint_url': ENDPOINT_URL},
+            )
+            store = s3fs.S3Map(root=root, s3=s3, check=False)
+        if cache_directory is not None:
+            # Chunks are read from the local directory before S3
+            store = DiskStoreCache(store, root, cache_directory,
+                                   disk_cache_size_mb * 2**20)
+        plate_stores[plate_id] = zarr.LRUStoreCache(
+            store, max_size=(cache_size_mb * 2**20))
+    return plate_stores[plate_id]
+
+
+def load_plate_index(plate):
+    # Map (row, column, field) of each Well to the path of its Zarr image.
+    # Built once per plate from the metadata of the plate.
+    plate_id = plate.getId()
+    if plate_id in plate_indexes:
+        return plate_indexes[plate_id]
+    root = zarr.open_group(load_plate_store(plate_id), mode='r')
+    index = {}
+    if 'plate' in root.attrs:
+        metadata = root.attrs['plate']
+        rows = [row['name'] for row in metadata['rows']]
+        columns = [column['name'] for column in metadata['columns']]
+        for well in metadata['wells']:
+            # The path of a Well ends with row/column
+            row_name, column_name = well['path'].split('/')[-2:]
+            row = well.get('rowIndex')
+            if row is None:
+                row = rows.index(row_name)
+            column = well.get('columnIndex')
+            if column is None:
+                column = columns.index(column_name)
+            images = root[well['path']].attrs['well']['images']
+            for field, image in enumerate(images):
+                index[(row, column, field)] = '%s/%s' % (well['path'],
+                                                         image['path'])
+    else:
+        # No plate metadata: one series per field,
+        # the Wells are in row-major order
+        grid = plate.getGridSize()
+        # (min, max) index of the fields, None if the plate has no field
+        field_range = plate.getNumberOfFields()
+        fields = field_range[1] + 1 if field_range is not None else 1
+        for row in range(grid['rows']):
+            for column in range(grid['columns']):
+                for field in range(fields):
+                    series = (row * grid['columns'] + column) * fields + field
+                    index[(row, column, field)] = str(series)
+    plate_indexes[plate_id] = index
+    return index
+
+
+def load_dask_array_from_s3(plate_id, path, resolution='0'):
+    cached_store = load_plate_store(plate_id)
     # data.shape is (t, c, z, y, x) by convention
-    return da.from_zarr(cached_store)
+    return da.from_zarr(cached_store,
+                        component='%s/%s' % (path, resolution))
+
+
+def cache_info(plate_id):
+    # Use the hits and misses to size the cache
+    cached_store = plate_stores[plate_id]
+    return {
+        'hits': cached_store.hits,
+        'misses': cached_store.misses,
+        'size_mb': cached_store._current_size / 2**20,
+    }
+
+
+# Multiscale
+def resolution_levels(plate_id, zarr_path):
+    # Path and downsampling factor of each level of the pyramid
+    group = zarr.open_group(load_plate_store(plate_id), mode='r',
+                            path=zarr_path)
+    datasets = group.attrs['multiscales'][0]['datasets']
+    size_x = group[datasets[0]['path']].shape[-1]
+    return [(d['path'], size_x / group[d['path']].shape[-1])
+            for d in datasets]
+
+
+def choose_resolution(plate, target_pixel_size):
+    # Lowest resolution with pixels not larger than target_pixel_size.
+    # Sizes are in the unit of the pixel size of the images, or in pixels
+    # if the images have no pixel size
+    well = next(plate.listChildren())
+    image = well.getImage(0)
+    pixel_size = image.getPixelSizeX() or 1
+    zarr_path = load_plate_index(plate)[(well.row, well.column, 0)]
+    resolution, factor = '0', 1
+    for path, level_factor in resolution_levels(plate.getId(), zarr_path):
+        if pixel_size * level_factor <= target_pixel_size:
+            if level_factor > factor:
+                resolution, factor = path, level_factor
+    return resolution, factor
+
+
+def rescale_pipeline(pipeline, factor):
+    # Sizes of the objects, in pixels, at the chosen resolution
+    for module in pipeline.modules():
+        if module.module_name == 'IdentifyPrimaryObjects':
+            min_size, max_size = module.size_range.value
+            module.size_range.value = '%d,%d' % (
+                max(1, round(min_size / factor)),
+                max(1, round(max_size / factor)))
+    return pipeline
+
+
+# Dask-analysis
+# Pipeline of each thread running the tasks, by thread ID.
+# A dict rather than a threading.local, which cannot be pickled.
+pipelines = {}
+
+
+def remove_export(pipeline):
+    # Measurements are read from the pipeline, no CSV file is written
+    for module in list(pipeline.modules()):
+        if module.module_name == 'ExportToSpreadsheet':
+            pipeline.remove_module(module.module_num)
+    return pipeline
+
+
+def read_measurements(measurements, object_name):
+    # One column per feature and one row per object
+    columns = {}
+    for feature in measurements.get_feature_names(object_name):
+        values = measurements.get_measurement(object_name, feature)
+        if values is not None:
+            columns[feature] = numpy.atleast_1d(values)
+    return pandas.DataFrame(columns)
+
+
+def field_pipeline(pipeline_path, factor):
+    # Loaded once per thread, on first use
+    thread_id = threading.get_ident()
+    if thread_id not in pipelines:
+        pipeline = remove_export(load_pipeline(pipeline_path))
+        rescale_pipeline(pipeline, factor)
+        pipelines[thread_id] = prepare_pipeline(pipeline)
+    return pipelines[thread_id]
+
+
+def load_field_planes(plate_id, zarr_path, resolution, cache_directory):
+    # Read through the store of the process, created on first use
+    store = load_plate_store(plate_id, cache_directory=cache_directory)
+    data = zarr.open_array(store, mode='r',
+                           path='%s/%s' % (zarr_path, resolution))
+    # Channels of the first timepoint and z-section
+    return data[0, :, 0, :, :]
+
+
+def analyze_field(plate_id, zarr_path, resolution, cache_directory,
+                  pipeline_path, factor, image_id, well_id, field):
+    planes = load_field_planes(plate_id, zarr_path, resolution,
+                               cache_directory)
+    pipeline = field_pipeline(pipeline_path, factor)
+    set_planes(pipeline, planes)
+    measurements = pipeline.run()
+    nuclei = read_measurements(measurements, 'Nuclei')
+    nuclei['Image'] = image_id
+    nuclei['Well'] = well_id
+    nuclei['Field'] = field
+    return nuclei
+
+
+def analyze_dask(plate, pipeline_path, scheduler='threads', resolution='0',
+                 factor=1, all_fields=False, cache_directory=None):
+    # One task per field, of all the acquisitions of the plate.
+    # Each task reads its planes through the store and the caches of its
+    # process, so no array nor cached chunk is sent with the tasks.
+    # scheduler is 'threads', 'processes' or a distributed Client
+    print("analyzing with dask...")
+    # Functions of the __main__ script are pickled by value, together
+    # with the globals they use. Tasks refer to the function of the module.
+    from idr0002_idr_zarr import analyze_field as analyze_task
+    plate_id = plate.getId()
+    plate_index = load_plate_index(plate)
+    tasks = []
+    for well in plate.listChildren():
+        fields = well.countWellSample() if all_fields else 1
+        for field in range(fields):
+            if (well.row, well.column, field) not in plate_index:
+                continue
+            image = well.getImage(field)
+            zarr_path = plate_index[(well.row, well.column, field)]
+            tasks.append(dask.delayed(analyze_task)(
+                plate_id, zarr_path, resolution, cache_directory,
+                pipeline_path, factor, image.getId(), well.getId(), field))
+    start = time.perf_counter()
+    nuclei = dask.delayed(pandas.concat)(tasks, ignore_index=True)
+    nuclei = nuclei.compute(scheduler=scheduler)
+    duration = time.perf_counter() - start
+    print("%s fields in %.1f s, %.2f fields/s" % (
+        len(tasks), duration, len(tasks) / duration if duration else 0))
+    print("analysis done")
+    return nuclei
+
+
+def aggregate_wells(nuclei):
+    # Mean of the measurements of all the fields of each Well
+    nuclei = nuclei.drop(columns=['Image', 'Field'])
+    return nuclei.groupby('Well', as_index=False).mean()
 
 
 # Disconnect
@@ -151,6 +490,11 @@ def main():
     # Collect user credentials
     try:
         plate_id = input("Plate ID [422]: ") or '422'
+        cache_directory = input("Local cache directory [none]: ") or None
+        target_pixel_size = float(
+            input("Target pixel size [full resolution]: ") or 0)
+        scheduler = input("Dask scheduler, threads or processes [none]: ")
+        all_fields = (input("Analyze all fields [no]: ") or 'no') == 'yes'
         # Connect to the server
         conn = connect()
 
@@ -161,7 +505,23 @@ def main():
         # Load the plate
         plate = load_plate(conn, plate_id)
 
-        analyze(plate, pipeline)
+        # Quick analyses can be run on a lower resolution
+        resolution, factor = '0', 1
+        if target_pixel_size > 0:
+            load_plate_store(plate.getId(), cache_directory=cache_directory)
+            resolution, factor = choose_resolution(plate, target_pixel_size)
+            print("resolution: %s, downsampled %sx" % (resolution, factor))
+            rescale_pipeline(pipeline, factor)
+
+        if scheduler:
+            load_plate_store(plate.getId(), cache_directory=cache_directory)
+            nuclei = analyze_dask(plate, pipeline_path, scheduler,
+                                  resolution, factor, all_fields,
+                                  cache_directory)
+            print(aggregate_wells(nuclei).describe())
+        else:
+            analyze(plate, pipeline, cache_directory, resolution,
+                    all_fields)
 
     finally:
         disconnect(conn)
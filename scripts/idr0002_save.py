@@ -24,14 +24,39 @@
 #
 # Version: 1.0
 #
+import contextlib
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
+import pickle
+import queue
 import tempfile
+import threading
+import time
 import warnings
 
+import numpy
+import pandas
+import scipy.ndimage
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+
 from getpass import getpass
 
 # Import OMERO Python BlitzGateway
+import Ice
+import omero
 from omero.gateway import BlitzGateway
+from omero.model import FileAnnotationI, OriginalFileI
+from omero.model import ImageI, MaskI, RoiI
+from omero.model import PlateAnnotationLinkI, PlateI
+from omero.rtypes import rdouble, rint, rstring, unwrap
+from omero.sys import ParametersI
 
 # Import Cell Profiler Dependencies
 # run headless
@@ -41,6 +66,8 @@ cpprefs.set_headless()  # noqa
 # end headless
 
 import cellprofiler_core.pipeline as cpp
+from cellprofiler_core.module import Module
+from cellprofiler_core.object import Objects
 
 
 # module used to inject OMERO image planes into Cell Profiler Pipeline
@@ -75,55 +102,344 @@ def load_pipeline(pipeline_path):
     return pipeline
 
 
+# Prepare-pipeline
+class InjectPlane(InjectImage):
+    # InjectImage module whose plane is replaced for each Image
+    def __init__(self, image_name, channel):
+        super(InjectPlane, self).__init__(image_name, None)
+        self.channel = channel
+
+    def set_plane(self, plane):
+        # The plane is passed in its pixel type, without copy. CellProfiler
+        # converts it to float once, scaled by the range of the pixel type.
+        self._InjectImage__image = plane
+
+
+def prepare_pipeline(pipeline, image_names=('OrigBlue', 'OrigGreen')):
+    # Add the modules injecting the planes once instead of copying
+    # the pipeline for each Image. Names of the channels expected
+    # in the pipeline, in the order of the Channels.
+    if any(isinstance(m, InjectPlane) for m in pipeline.modules()):
+        return pipeline
+    for c, image_name in enumerate(image_names):
+        inject_plane_module = InjectPlane(image_name, c)
+        inject_plane_module.set_module_num(1)
+        pipeline.add_module(inject_plane_module)
+    return pipeline
+
+
+def set_planes(pipeline, planes):
+    # Replace the planes injected in the prepared pipeline
+    for module in pipeline.modules():
+        if isinstance(module, InjectPlane):
+            module.set_plane(planes[module.channel])
+
+
+# Plate-index
+class PlateImage(namedtuple('PlateImage', [
+        'well_id', 'row', 'column', 'field', 'acquisition_id',
+        'image_id', 'name',
+        'pixels_id', 'size_x', 'size_y', 'size_z', 'size_c', 'size_t',
+        'pixels_type', 'channels'])):
+    # Metadata of an Image of the plate, read once for the whole plate
+    __slots__ = ()
+
+    def getId(self):
+        return self.image_id
+
+    def getName(self):
+        return self.name
+
+
+def load_plate_index(conn, plate_id):
+    # Wells, Images, Pixels and Channels of the plate in one query,
+    # instead of loading them Well by Well
+    query = """
+        select well.id, well.row, well.column, acquisition.id,
+               image.id, image.name, pixels.id,
+               pixels.sizeX, pixels.sizeY, pixels.sizeZ,
+               pixels.sizeC, pixels.sizeT, type.value, logical.name
+        from Well well
+        join well.wellSamples sample
+        left outer join sample.plateAcquisition acquisition
+        join sample.image image
+        join image.pixels pixels
+        join pixels.pixelsType type
+        join pixels.channels channel
+        join channel.logicalChannel logical
+        where well.plate.id = :id
+        order by well.row, well.column, sample.id, index(channel)
+        """
+    params = ParametersI()
+    params.addId(plate_id)
+    rows = conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+    images = []
+    fields = {}
+    for row in unwrap(rows):
+        well_id, well_row, well_column, acquisition_id = row[0:4]
+        channel_name = row[13]
+        if images and images[-1][5] == row[4]:
+            # Another Channel of the same Image
+            images[-1][14].append(channel_name)
+            continue
+        # Fields of all the acquisitions are numbered
+        # in the order of the WellSamples
+        field = fields.get(well_id, 0)
+        fields[well_id] = field + 1
+        images.append([well_id, well_row, well_column, field,
+                       acquisition_id] + row[4:13] + [[channel_name]])
+    return tuple(PlateImage(*(image[:14] + [tuple(image[14])]))
+                 for image in images)
+
+
+def select_images(plate_index, limit=None, all_fields=False):
+    # Images of the first limit Wells: all their fields,
+    # of all the acquisitions, or only the first field
+    well_ids = list(dict.fromkeys(image.well_id for image in plate_index))
+    well_ids = set(well_ids[0:limit])
+    return [image for image in plate_index
+            if image.well_id in well_ids and (all_fields or image.field == 0)]
+
+
+# Prefetch-planes
+# Pixels are sent by the server as big-endian bytes
+PIXEL_TYPES = {
+    'int8': '>i1', 'uint8': '>u1',
+    'int16': '>i2', 'uint16': '>u2',
+    'int32': '>i4', 'uint32': '>u4',
+    'float': '>f4', 'double': '>f8',
+}
+
+
+class PlaneBuffers(object):
+    # Arrays reused for the planes of the successive Images.
+    # Planes are kept in the pixel type of the server, e.g. uint16,
+    # and are converted to float by CellProfiler when injected,
+    # instead of keeping float64 copies of the planes in memory.
+
+    def __init__(self):
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        with self.lock:
+            for i, planes in enumerate(self.free):
+                if planes.shape == shape and planes.dtype == dtype:
+                    return self.free.pop(i)
+        return numpy.empty(shape, dtype=dtype)
+
+    def release(self, planes):
+        with self.lock:
+            self.free.append(planes)
+
+
+def read_planes(conn, pixels_id, pixels_type, size_x, size_y, size_c,
+                z=0, t=0, x=0, y=0, buffers=None):
+    # Load the planes of all Channels in a single call
+    # instead of one getPlane() call per Channel
+    store = conn.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+        # offset, size and step are in XYZCT order
+        data = store.getHypercube([x, y, z, 0, t],
+                                  [size_x, size_y, 1, size_c, 1],
+                                  [1, 1, 1, 1, 1], conn.SERVICE_OPTS)
+    finally:
+        store.close()
+    dtype = numpy.dtype(PIXEL_TYPES[pixels_type])
+    planes = numpy.frombuffer(data, dtype=dtype)
+    # Array of shape (c, y, x) in native byte order
+    planes = planes.reshape(size_c, size_y, size_x)
+    if buffers is None:
+        return planes.astype(dtype.newbyteorder('='))
+    out = buffers.acquire(planes.shape, dtype.newbyteorder('='))
+    out[...] = planes
+    return out
+
+
+def load_indexed_planes(conn, image, buffers=None):
+    # Planes of an Image of the plate index, no other call to the server
+    with timed('fetch', image=image.image_id) as event:
+        planes = read_planes(conn, image.pixels_id, image.pixels_type,
+                             image.size_x, image.size_y, image.size_c,
+                             buffers=buffers)
+        event['bytes'] = planes.nbytes
+    return planes
+
+
+def prefetch(objects, load, depth=2):
+    # Download the data of the next objects in a background thread
+    # while the current one is analyzed. At most depth are kept in memory.
+    loaded = queue.Queue(maxsize=depth)
+    done = object()
+
+    def download():
+        try:
+            for obj in objects:
+                loaded.put((obj, load(obj)))
+        except Exception as e:
+            loaded.put((done, e))
+            return
+        loaded.put((done, None))
+
+    threading.Thread(target=download, daemon=True).start()
+    while True:
+        obj, data = loaded.get()
+        if obj is done:
+            if data is not None:
+                raise data
+            return
+        yield obj, data
+
+
 # Analyze-data
-def analyze(plate, pipeline):
+def analyze_image(image, planes, pipeline, output_directory, cache=None):
+    print(image.getName())
+    cached = None
+    if cache is not None:
+        # Segmentation of the Image by the same first modules
+        cached = load_segmentation(pipeline, cache, image)
+    cpprefs.set_default_output_directory(output_directory)
+    # For each Image in OMERO, we only replace the injected planes
+    set_planes(pipeline, planes)
+    with timed('run', image=image.getId()), \
+            timed_export(pipeline, image.getId()):
+        measurements = pipeline.run()
+    emit_module_times(measurements, image.getId())
+    if cached is not None:
+        save_segmentation(pipeline, cached)
+
+    # Results obtained as CSV from Cell Profiler
+    return output_directory + '/Nuclei.csv'
+
+
+def analyze(plate, pipeline, limit=5, ledger=None, all_fields=False,
+            rois=False, tile_size=None, cache=None):
     warnings.filterwarnings('ignore')
     print("analyzing...")
-    # Set Cell Output Directory
-    new_output_directory = os.path.normcase(tempfile.mkdtemp())
-    cpprefs.set_default_output_directory(new_output_directory)
+    if tile_size is not None and rois:
+        print("ROIs are not saved when the images are analyzed by tiles")
+        rois = False
+    with timed('prepare_pipeline'):
+        prepare_pipeline(pipeline)
+        if cache is not None:
+            cache_segmentation(pipeline)
+        if rois:
+            capture_objects(pipeline)
+    pending_rois = list()
+    results = list()
+    conn = plate._conn
+    with timed('list_wells', plate=plate.getId()):
+        # Wells, Images, Pixels and Channels of the plate in one query
+        plate_index = load_plate_index(conn, plate.getId())
+    # By default, use the first field of the first 5 wells
+    images = select_images(plate_index, limit, all_fields)
+    if ledger is not None:
+        # Skip the Images analyzed by a previous run
+        for entry in ledger.pending_entries(plate.getId(), images):
+            results.append((entry['well'], entry.get('field', 0),
+                            entry['result']))
+        images = ledger.remaining(plate.getId(), images)
+    start = time.perf_counter()
+    if tile_size is not None:
+        # Large Images are read tile by tile, not prefetched
+        analyzed = ((image, None) for image in images)
+    else:
+        # The planes of the next Images are downloaded during the analysis,
+        # into arrays reused once an Image is analyzed
+        buffers = PlaneBuffers()
+        load = functools.partial(load_indexed_planes, conn, buffers=buffers)
+        analyzed = prefetch(images, load)
+    for image, planes in analyzed:
+        # Set Cell Output Directory, one per Image so results are kept
+        new_output_directory = os.path.normcase(tempfile.mkdtemp())
+        if planes is None:
+            path = analyze_tiled(conn, image, pipeline,
+                                 new_output_directory, tile_size)
+        else:
+            path = analyze_image(image, planes, pipeline,
+                                 new_output_directory, cache)
+            buffers.release(planes)
+        if rois:
+            # ROIs of several Images are saved together
+            pending_rois.extend(labels_to_rois(image.getId(),
+                                               captured_labels(pipeline)))
+            if len(pending_rois) >= ROI_BATCH_SIZE:
+                save_rois(conn, pending_rois)
+                pending_rois = list()
+        if ledger is not None:
+            ledger.record(plate.getId(), image, path)
+        results.append((image.well_id, image.field, path))
+    if pending_rois:
+        save_rois(conn, pending_rois)
+    print_throughput(len(images), time.perf_counter() - start)
+    print("analysis done")
+    return aggregate_wells(results)
+
+
+def print_throughput(count, duration):
+    print("%s fields in %.1f s, %.2f fields/s" % (
+        count, duration, count / duration if duration else 0))
 
+
+def aggregate_wells(results):
+    # One CSV file per Well with the objects of all its fields
+    fields = {}
+    for well_id, field, path in results:
+        fields.setdefault(well_id, []).append((field, path))
     files = list()
-    wells = list(plate.listChildren())
-    wells = wells[0:5]  # use the first 5 wells
-    for count, well in enumerate(wells):
-        # Load a single Image per Well
-        image = well.getImage(0)
-        print(image.getName())
-        pixels = image.getPrimaryPixels()
-        size_c = image.getSizeC()
-        # For each Image in OMERO, we copy pipeline and inject image modules
-        pipeline_copy = pipeline.copy()
-        # Inject image for each Channel (pipeline only handles 2 channels)
-        for c in range(0, size_c):
-            plane = pixels.getPlane(0, c, 0)
-            image_name = image.getName()
-            # Name of the channel expected in the pipeline
-            if c == 0:
-                image_name = 'OrigBlue'
-            if c == 1:
-                image_name = 'OrigGreen'
-            inject_image_module = InjectImage(image_name, plane)
-            inject_image_module.set_module_num(1)
-            pipeline_copy.add_module(inject_image_module)
-        pipeline_copy.run()
-
-        # Results obtained as CSV from Cell Profiler
-        path = new_output_directory + '/Nuclei.csv'
+    for well_id, well_fields in fields.items():
+        if len(well_fields) == 1:
+            files.append(well_fields[0][1])
+            continue
+        frames = []
+        for field, path in sorted(well_fields):
+            frame = pandas.read_csv(path, index_col=None, header=0)
+            frame['Field'] = field
+            frames.append(frame)
+        path = os.path.normcase(tempfile.mkdtemp()) + '/Nuclei.csv'
+        pandas.concat(frames, ignore_index=True).to_csv(path, index=False)
         files.append(path)
-    print("analysis done")
     return files
 
 
 # Save-results
-def save_results(conn, files, plate):
-    # Upload the CSV files
+def upload_file(conn, path):
+    return conn.createOriginalFileFromLocalFile(path, mimetype="text/csv")
+
+
+def save_links(conn, links):
+    conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+
+
+def save_results(conn, files, plate, workers=4, pool=None):
+    # Upload the CSV files in parallel. With a pool of connections,
+    # each upload thread uses its own connection.
     print("saving results...")
     namespace = "cellprofiler.demo.namespace"
-    for f in files:
-        ann = conn.createFileAnnfromLocalFile(f, mimetype="text/csv",
-                                              ns=namespace, desc=None)
-        plate.linkAnnotation(ann)
+    if pool is not None:
+        workers = pool.size
+        upload = functools.partial(pool.call, upload_file)
+    else:
+        upload = functools.partial(upload_file, conn)
+    with timed('upload', files=len(files)) as event, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        orig_files = list(executor.map(upload, files))
+        event['bytes'] = sum(os.path.getsize(f) for f in files)
+    # Create all the annotations and the links to the plate in one call
+    links = []
+    for orig_file in orig_files:
+        ann = FileAnnotationI()
+        ann.setFile(OriginalFileI(orig_file.getId(), False))
+        ann.setNs(rstring(namespace))
+        link = PlateAnnotationLinkI()
+        link.setParent(PlateI(plate.getId(), False))
+        link.setChild(ann)
+        links.append(link)
+    if pool is not None:
+        pool.call(save_links, links)
+    else:
+        save_links(conn, links)
 
 
 # Disconnect
@@ -131,6 +447,686 @@ def disconnect(conn):
     conn.close()
 
 
+# Parallel-analysis
+# State of a worker process: its own session and its own pipeline
+worker = {}
+
+
+def init_worker(host, session_uuid, pipeline_path, events=None, rois=False,
+                cache=None, started=None):
+    global events_path
+    warnings.filterwarnings('ignore')
+    events_path = events
+    # Receives the ID of each Image when its analysis starts
+    worker['started'] = started
+    # Join the session of the parent process instead of logging in again
+    worker['host'] = host
+    worker['session_uuid'] = session_uuid
+    worker['conn'] = join_session(host, session_uuid)
+    worker['pipeline'] = prepare_pipeline(load_pipeline(pipeline_path))
+    worker['rois'] = rois
+    worker['cache'] = cache
+    if cache is not None:
+        cache_segmentation(worker['pipeline'])
+    if rois:
+        capture_objects(worker['pipeline'])
+
+
+def load_field(image):
+    try:
+        return load_indexed_planes(worker['conn'], image)
+    except SESSION_ERRORS:
+        # Join the session again and retry once
+        worker['conn'].close(hard=False)
+        worker['conn'] = join_session(worker['host'], worker['session_uuid'])
+        return load_indexed_planes(worker['conn'], image)
+
+
+# Returned when the session of the workers has expired
+SESSION_LOST = "session lost"
+
+
+def analyze_field(image):
+    if worker['started'] is not None:
+        worker['started'].put(image.image_id)
+    # Errors are returned, so one failing field does not stop the run
+    try:
+        planes = load_field(image)
+        output_directory = os.path.normcase(tempfile.mkdtemp())
+        path = analyze_image(image, planes, worker['pipeline'],
+                             output_directory, worker['cache'])
+        if worker['rois']:
+            labels = captured_labels(worker['pipeline'])
+            save_rois(worker['conn'], labels_to_rois(image.getId(), labels))
+        return image, path, None
+    except SESSION_ERRORS:
+        # The field is analyzed again in a new session
+        return image, None, SESSION_LOST
+    except Exception as e:
+        return image, None, repr(e)
+
+
+def run_fields(images, workers, context, initargs, record=None):
+    # Yield the results of the fields until a worker dies, e.g. killed
+    # when out of memory. Then all the fields not done are lost.
+    # Returns the lost fields, the IDs of the Images which had started
+    # and the fields not analyzed because the session expired.
+    started = initargs[-1]
+    lost = []
+    expired = []
+    with ProcessPoolExecutor(workers, mp_context=context,
+                             initializer=init_worker,
+                             initargs=initargs) as executor:
+        futures = dict((executor.submit(analyze_field, image), image)
+                       for image in images)
+        # Results are returned as soon as each field is done
+        for future in as_completed(futures):
+            try:
+                image, path, error = future.result()
+            except BrokenProcessPool:
+                lost.append(futures[future])
+                continue
+            if error == SESSION_LOST:
+                expired.append(image)
+                continue
+            if record is not None and error is None:
+                record(image, path)
+            yield image, path, error
+    started_ids = set()
+    while not started.empty():
+        started_ids.add(started.get())
+    return lost, started_ids, expired
+
+
+def analyze_parallel(conn, plate, pipeline_path, workers=None, limit=5,
+                     ledger=None, all_fields=False, rois=False, retries=1,
+                     pool=None, cache=None):
+    # Each field is analyzed independently of the other fields of its Well
+    print("analyzing with %s workers..." % (workers or os.cpu_count()))
+    plate_index = load_plate_index(conn, plate.getId())
+    images = select_images(plate_index, limit, all_fields)
+    if ledger is not None:
+        # Skip the Images analyzed by a previous run
+        indexed = dict((image.image_id, image) for image in images)
+        for entry in ledger.pending_entries(plate.getId(), images):
+            yield indexed[entry['image']], entry['result'], None
+        images = ledger.remaining(plate.getId(), images)
+    start = time.perf_counter()
+    if pool is not None:
+        session_uuid = pool.session_uuid
+    else:
+        session_uuid = conn.getSession().getUuid().getValue()
+    # "spawn" so that no Ice connection is shared with the forked workers
+    context = multiprocessing.get_context("spawn")
+    started = context.SimpleQueue()
+    record = None
+    if ledger is not None:
+        record = functools.partial(ledger.record, plate.getId())
+    # When a worker dies, the fields which had not started are analyzed
+    # again by a new pool. The fields which were running are analyzed
+    # again one at a time, so only the field killing its worker is
+    # counted as failed, after retries attempts.
+    attempts = dict((image.image_id, 0) for image in images)
+    remaining = images
+    while remaining:
+        # The workers of each pool join the current session
+        initargs = (conn.host, session_uuid, pipeline_path, events_path,
+                    rois, cache, started)
+        lost, started_ids, expired = yield from run_fields(
+            remaining, workers, context, initargs, record)
+        running = [image for image in lost if image.image_id in started_ids]
+        if lost and not running:
+            # The workers died before starting, e.g. when joining the session
+            running = lost
+        remaining = [image for image in lost if image not in running]
+        for image in running:
+            while True:
+                crashed, _, lost_session = yield from run_fields(
+                    [image], 1, context, initargs, record)
+                expired.extend(lost_session)
+                if not crashed:
+                    break
+                attempts[image.image_id] += 1
+                if attempts[image.image_id] > retries:
+                    yield image, None, "worker process died"
+                    break
+        if expired:
+            # Fields of an expired session are analyzed again
+            # if the pool of the parent created a new session
+            previous_uuid = session_uuid
+            if pool is not None:
+                session_uuid = pool.renew()
+            if session_uuid == previous_uuid:
+                for image in expired:
+                    yield image, None, SESSION_LOST
+            else:
+                remaining.extend(expired)
+    print_throughput(len(images), time.perf_counter() - start)
+    print("analysis done")
+
+
+# Session-pool
+# Errors raised when the session or its connection is lost
+SESSION_ERRORS = (
+    Ice.ConnectionLostException,
+    Ice.ObjectNotExistException,
+    omero.RemovedSessionException,
+    omero.SessionTimeoutException,
+)
+
+
+def join_session(host, session_uuid):
+    conn = BlitzGateway(host=host, secure=True)
+    if not conn.connect(sUuid=session_uuid):
+        raise omero.RemovedSessionException(
+            message="cannot join session %s" % session_uuid)
+    conn.c.enableKeepAlive(60)
+    return conn
+
+
+class SessionPool(object):
+    # Connections joining a single session, shared by threads.
+    # The session is created again if it expires.
+
+    def __init__(self, host, username, password, size=4):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.size = size
+        self.connections = queue.Queue()
+        self.lock = threading.Lock()
+        self.login()
+
+    def login(self):
+        self.conn = connect(self.host, self.username, self.password)
+        self.conn.c.enableKeepAlive(60)
+        self.session_uuid = self.conn.getSession().getUuid().getValue()
+        for i in range(self.size):
+            self.connections.put(join_session(self.host, self.session_uuid))
+
+    def healthy(self, conn):
+        try:
+            return conn.keepAlive()
+        except Exception:
+            return False
+
+    def acquire(self):
+        # Not checked before use, a lost session is detected by call().
+        # None stands for a connection closed by a failed reconnect.
+        conn = self.connections.get()
+        if conn is None:
+            try:
+                conn = join_session(self.host, self.session_uuid)
+            except Exception:
+                self.connections.put(None)
+                raise
+        return conn
+
+    def release(self, conn):
+        self.connections.put(conn)
+
+    def renew(self):
+        # Log in again only if the session itself has expired.
+        # Returns the UUID of the current session.
+        with self.lock:
+            if not self.healthy(self.conn):
+                self.conn.close(hard=False)
+                self.conn = connect(self.host, self.username, self.password)
+                self.conn.c.enableKeepAlive(60)
+                self.session_uuid = \
+                    self.conn.getSession().getUuid().getValue()
+            return self.session_uuid
+
+    def reconnect(self, conn):
+        conn.close(hard=False)
+        return join_session(self.host, self.renew())
+
+    def call(self, function, *args):
+        # Run function(conn, *args), retried once if the session was lost
+        conn = self.acquire()
+        try:
+            return function(conn, *args)
+        except SESSION_ERRORS:
+            # Only a live connection is put back in the pool
+            lost, conn = conn, None
+            conn = self.reconnect(lost)
+            return function(conn, *args)
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            conn = self.connections.get()
+            if conn is not None:
+                conn.close(hard=False)
+        self.conn.close()
+
+
+# Save-ROIs
+# Number of ROIs saved in a single call
+ROI_BATCH_SIZE = 500
+
+
+class CaptureObjects(Module):
+    # Last module of the pipeline, keeping the label matrices of the
+    # objects which are otherwise discarded at the end of the run
+    module_name = "CaptureObjects"
+    category = "Other"
+    variable_revision_number = 1
+
+    def __init__(self, object_names):
+        super(CaptureObjects, self).__init__()
+        self.object_names = object_names
+        self.labels = {}
+
+    def settings(self):
+        return []
+
+    def run(self, workspace):
+        for object_name in self.object_names:
+            objects = workspace.object_set.get_objects(object_name)
+            self.labels[object_name] = objects.segmented
+
+
+def capture_objects(pipeline, object_names=('Nuclei', 'PH3')):
+    if any(isinstance(m, CaptureObjects) for m in pipeline.modules()):
+        return pipeline
+    module = CaptureObjects(object_names)
+    module.set_module_num(len(pipeline.modules()) + 1)
+    pipeline.add_module(module)
+    return pipeline
+
+
+def captured_labels(pipeline):
+    # Label matrices of the last run, by object name
+    for module in pipeline.modules():
+        if isinstance(module, CaptureObjects):
+            labels, module.labels = module.labels, {}
+            return labels
+    return {}
+
+
+def labels_to_rois(image_id, labels):
+    # One ROI with a Mask per object. The bounding boxes of all the
+    # objects are found in a single pass over the label matrix.
+    rois = []
+    for object_name, label_matrix in labels.items():
+        boxes = scipy.ndimage.find_objects(label_matrix)
+        for label, box in enumerate(boxes, start=1):
+            if box is None:
+                continue
+            mask = label_matrix[box] == label
+            shape = MaskI()
+            shape.setX(rdouble(box[1].start))
+            shape.setY(rdouble(box[0].start))
+            shape.setWidth(rdouble(mask.shape[1]))
+            shape.setHeight(rdouble(mask.shape[0]))
+            shape.setBytes(numpy.packbits(mask).tobytes())
+            shape.setTheZ(rint(0))
+            shape.setTheT(rint(0))
+            shape.setTextValue(rstring(object_name))
+            roi = RoiI()
+            roi.setImage(ImageI(image_id, False))
+            roi.setName(rstring(object_name))
+            roi.addShape(shape)
+            rois.append(roi)
+    return rois
+
+
+def save_rois(conn, rois, batch_size=ROI_BATCH_SIZE):
+    with timed('save_rois', rois=len(rois)):
+        update_service = conn.getUpdateService()
+        for i in range(0, len(rois), batch_size):
+            update_service.saveArray(rois[i:i + batch_size],
+                                     conn.SERVICE_OPTS)
+
+
+# Checkpoint
+class Ledger(object):
+    # Images already analyzed with a pipeline, saved as one JSON line
+    # per Image, so a failed run can be restarted where it stopped
+
+    def __init__(self, path, pipeline_path):
+        self.path = path
+        with open(pipeline_path, 'rb') as f:
+            self.pipeline = hashlib.sha1(f.read()).hexdigest()
+        self.entries = {}
+        # Entries returned or recorded by this run, uploaded at its end
+        self.selected = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    # Results of another pipeline cannot be reused
+                    if entry['pipeline'] == self.pipeline:
+                        key = (entry['plate'], entry['image'])
+                        self.entries[key] = entry
+
+    def record(self, plate_id, image, result, uploaded=False):
+        entry = {
+            'plate': plate_id,
+            'well': image.well_id,
+            'field': image.field,
+            'image': image.image_id,
+            'pipeline': self.pipeline,
+            'result': result,
+            'uploaded': uploaded,
+        }
+        self._write(entry)
+        self.selected.add((plate_id, image.image_id))
+
+    def _write(self, entry):
+        self.entries[(entry['plate'], entry['image'])] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def available(self, entry):
+        # Results not uploaded are temporary files, e.g. removed on reboot
+        return entry['uploaded'] or os.path.exists(entry['result'])
+
+    def remaining(self, plate_id, images):
+        # Images not analyzed yet, or whose results are lost
+        remaining = []
+        for image in images:
+            entry = self.entries.get((plate_id, image.image_id))
+            if entry is None or not self.available(entry):
+                remaining.append(image)
+        return remaining
+
+    def pending_entries(self, plate_id, images):
+        # Images analyzed but with results not uploaded yet
+        entries = [self.entries.get((plate_id, image.image_id))
+                   for image in images]
+        entries = [entry for entry in entries
+                   if entry is not None and not entry['uploaded'] and
+                   self.available(entry)]
+        self.selected.update((plate_id, entry['image']) for entry in entries)
+        return entries
+
+    def set_uploaded(self, plate_id):
+        # Called once the results returned by this run are uploaded.
+        # Entries of the plate not selected by this run stay pending.
+        for key in sorted(self.selected):
+            if key[0] == plate_id and not self.entries[key]['uploaded']:
+                self._write(dict(self.entries[key], uploaded=True))
+        self.selected = set(key for key in self.selected
+                            if key[0] != plate_id)
+
+
+# Segmentation-cache
+class SegmentationCache(Module):
+    # Placed after the Identify modules. Saves the objects and the
+    # measurements of the Identify modules, or restores them instead of
+    # running these modules, so that the later modules, e.g. the
+    # thresholds of ClassifyObjects, can be changed without segmenting
+    # the Images again
+    module_name = "SegmentationCache"
+    category = "Other"
+    variable_revision_number = 1
+
+    def __init__(self, identify_modules):
+        super(SegmentationCache, self).__init__()
+        self.identify_modules = identify_modules
+        self.restored = None
+        self.saved = None
+
+    def settings(self):
+        return []
+
+    def run(self, workspace):
+        if self.restored is None:
+            self.save(workspace)
+            return
+        for name, labels in self.restored['objects'].items():
+            objects = Objects()
+            (objects.segmented, objects.unedited_segmented,
+             objects.small_removed_segmented) = labels
+            workspace.object_set.add_objects(objects, name)
+        for object_name, feature, value in self.restored['measurements']:
+            workspace.measurements.add_measurement(object_name, feature,
+                                                   value)
+
+    def save(self, workspace):
+        columns = []
+        for module in self.identify_modules:
+            columns.extend(module.get_measurement_columns(workspace.pipeline))
+        # The objects created are the ones with an object number
+        objects = {}
+        for column in columns:
+            if column[1] == 'Number_Object_Number':
+                o = workspace.object_set.get_objects(column[0])
+                objects[column[0]] = (o.segmented, o.unedited_segmented,
+                                      o.small_removed_segmented)
+        measurements = []
+        for column in columns:
+            object_name, feature = column[0], column[1]
+            if workspace.measurements.has_current_measurements(
+                    object_name, feature):
+                measurements.append((
+                    object_name, feature,
+                    workspace.measurements.get_current_measurement(
+                        object_name, feature)))
+        self.saved = {'objects': objects, 'measurements': measurements}
+
+
+def cache_segmentation(pipeline):
+    # Cache the results of the first Identify modules following each other
+    if segmentation_cache(pipeline) is not None:
+        return pipeline
+    modules = pipeline.modules()
+    identify = []
+    for module in modules:
+        if module.module_name.startswith('Identify'):
+            identify.append(module)
+        elif identify:
+            break
+    if identify:
+        module = SegmentationCache(identify)
+        module.set_module_num(identify[-1].module_num + 1)
+        pipeline.add_module(module)
+    return pipeline
+
+
+def segmentation_cache(pipeline):
+    for module in pipeline.modules():
+        if isinstance(module, SegmentationCache):
+            return module
+    return None
+
+
+def prefix_key(pipeline, cache_module):
+    # Hash of the settings of the modules up to the cached Identify
+    # modules. The settings of the later modules are not part of the key.
+    sha1 = hashlib.sha1()
+    for module in pipeline.modules():
+        if module is cache_module:
+            break
+        sha1.update(module.module_name.encode())
+        if isinstance(module, InjectPlane):
+            sha1.update(str(module.channel).encode())
+        for setting in module.settings():
+            sha1.update(str(setting.value_text).encode())
+    return sha1.hexdigest()
+
+
+def load_segmentation(pipeline, cache, image):
+    # Restore the segmentation of the Image if it is in the cache,
+    # otherwise run the Identify modules. Returns the path of the file
+    # of the Image in the cache. The pixels of an Image are not modified
+    # once imported, so the Pixels ID identifies the planes.
+    module = segmentation_cache(pipeline)
+    if module is None:
+        return None
+    key = '%s-%s' % (image.pixels_id, prefix_key(pipeline, module))
+    path = os.path.join(cache, key + '.pickle')
+    module.saved = None
+    module.restored = None
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            module.restored = pickle.load(f)
+    for identify in module.identify_modules:
+        identify.enabled = module.restored is None
+    return path
+
+
+def save_segmentation(pipeline, path):
+    module = segmentation_cache(pipeline)
+    if module is None or module.saved is None:
+        return
+    # Written then renamed, so an incomplete file is never read
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(module.saved, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+# Instrumentation
+# File receiving the events, one JSON line per event. None to disable.
+events_path = None
+events_lock = threading.Lock()
+
+
+def current_rss():
+    # Resident memory in bytes, read from /proc on Linux
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def emit(event):
+    if events_path is None:
+        return
+    event['time'] = time.time()
+    event['pid'] = os.getpid()
+    with events_lock, open(events_path, 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+@contextlib.contextmanager
+def timed(stage, **fields):
+    # Emit the duration and the memory change of a stage.
+    # Other values, e.g. 'bytes', can be added to the event.
+    event = dict(stage=stage, **fields)
+    rss = current_rss()
+    start = time.perf_counter()
+    try:
+        yield event
+    finally:
+        event['duration'] = time.perf_counter() - start
+        event['rss_delta'] = current_rss() - rss
+        emit(event)
+
+
+@contextlib.contextmanager
+def timed_export(pipeline, image_id):
+    # ExportToSpreadsheet writes the CSV files in post_run, which is not
+    # included in its ExecutionTime_ measurement
+    modules = [module for module in pipeline.modules()
+               if module.module_name == 'ExportToSpreadsheet']
+    for module in modules:
+        def post_run(workspace, post_run=module.post_run):
+            with timed('export', image=image_id):
+                return post_run(workspace)
+        module.post_run = post_run
+    try:
+        yield
+    finally:
+        # Back to the post_run of the class
+        for module in modules:
+            del module.post_run
+
+
+def emit_module_times(measurements, image_id):
+    # CellProfiler measures the execution time of each module
+    prefix = 'ExecutionTime_'
+    for feature in measurements.get_feature_names('Image'):
+        if feature.startswith(prefix):
+            duration = measurements.get_measurement('Image', feature)
+            emit({'stage': 'module', 'module': feature[len(prefix):],
+                  'image': image_id, 'duration': float(duration)})
+
+
+# Tiled-analysis
+def read_measurements(measurements, object_name):
+    # One column per feature and one row per object
+    columns = {}
+    for feature in measurements.get_feature_names(object_name):
+        values = measurements.get_measurement(object_name, feature)
+        if values is not None:
+            columns[feature] = numpy.atleast_1d(values)
+    return pandas.DataFrame(columns)
+
+
+def tiles(size_x, size_y, tile_size, overlap):
+    # Tiles of tile_size pixels, read with overlap pixels on each side.
+    # Returns the region to read and the region the tile is responsible for
+    for y in range(0, size_y, tile_size):
+        for x in range(0, size_x, tile_size):
+            x0 = max(x - overlap, 0)
+            y0 = max(y - overlap, 0)
+            x1 = min(x + tile_size + overlap, size_x)
+            y1 = min(y + tile_size + overlap, size_y)
+            core = (x, y, min(x + tile_size, size_x),
+                    min(y + tile_size, size_y))
+            yield (x0, y0, x1 - x0, y1 - y0), core
+
+
+def remove_export(pipeline):
+    # Measurements are read from the pipeline, no CSV file is written
+    for module in list(pipeline.modules()):
+        if module.module_name == 'ExportToSpreadsheet':
+            pipeline.remove_module(module.module_num)
+    return pipeline
+
+
+def analyze_tiled(conn, image, pipeline, output_directory, tile_size=1024,
+                  overlap=64, object_name='Nuclei'):
+    # Analyze a large Image of the plate index tile by tile, so only one
+    # tile is in memory. overlap must be larger than the objects, so that
+    # each object is entirely in at least one tile.
+    print(image.getName())
+    prepare_pipeline(pipeline)
+    remove_export(pipeline)
+    results = []
+    columns = []
+    for tile, core in tiles(image.size_x, image.size_y, tile_size, overlap):
+        x, y, size_x, size_y = tile
+        with timed('fetch', image=image.image_id) as event:
+            planes = read_planes(conn, image.pixels_id, image.pixels_type,
+                                 size_x, size_y, image.size_c, x=x, y=y)
+            event['bytes'] = planes.nbytes
+        set_planes(pipeline, planes)
+        with timed('run', image=image.image_id):
+            measurements = pipeline.run()
+        objects = read_measurements(measurements, object_name)
+        columns = list(objects.columns)
+        if len(objects.index) == 0:
+            continue
+        # Coordinates in the image
+        objects['Location_Center_X'] += x
+        objects['Location_Center_Y'] += y
+        # Objects in the overlap are kept by the tile containing their center
+        center_x = objects['Location_Center_X']
+        center_y = objects['Location_Center_Y']
+        inside = (center_x >= core[0]) & (center_x < core[2]) & \
+            (center_y >= core[1]) & (center_y < core[3])
+        results.append(objects[inside])
+    path = output_directory + '/%s.csv' % object_name
+    if results:
+        objects = pandas.concat(results, ignore_index=True)
+        # Objects are numbered from 1 in each tile, number them in the image
+        objects['ObjectNumber'] = numpy.arange(1, len(objects.index) + 1)
+        if 'Number_Object_Number' in objects:
+            objects['Number_Object_Number'] = objects['ObjectNumber']
+    else:
+        # Only the header, with the columns of the measurements
+        objects = pandas.DataFrame(columns=columns + ['ObjectNumber'])
+    objects.to_csv(path, index=False)
+    return path
+
+
 # main
 def main():
     # Collect user credentials
@@ -138,20 +1134,53 @@ def main():
     username = input("Username [trainer-1]: ") or 'trainer-1'
     password = getpass("Password: ")
     plate_id = input("Plate ID [102]: ") or '102'
-    # Connect to the server
-    conn = connect(host, username, password)
+    workers = int(input("Number of workers [1]: ") or '1')
+    all_fields = (input("Analyze all fields [no]: ") or 'no') == 'yes'
+    rois = (input("Save the objects as ROIs [no]: ") or 'no') == 'yes'
+    tile_size = int(input("Tile size, for large images [none]: ") or 0)
+    cache = input("Segmentation cache directory [none]: ") or None
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+    ledger_path = input("Checkpoint file [none]: ") or None
+    global events_path
+    events_path = input("Events file [none]: ") or None
+
+    # Connect to the server, with one connection per upload thread
+    with timed('connect'):
+        pool = SessionPool(host, username, password)
+    conn = pool.conn
 
     # Read the pipeline
     pipeline_path = "../notebooks/pipelines/ExamplePercentPositive.cppipe"
-    pipeline = load_pipeline(pipeline_path)
+
+    # Wells already analyzed are skipped when the run is restarted
+    ledger = None
+    if ledger_path is not None:
+        ledger = Ledger(ledger_path, pipeline_path)
 
     # Load the plate
     plate = load_plate(conn, plate_id)
 
-    files = analyze(plate, pipeline)
+    if workers > 1:
+        results = list()
+        for image, path, error in analyze_parallel(
+                conn, plate, pipeline_path, workers, ledger=ledger,
+                all_fields=all_fields, rois=rois, pool=pool, cache=cache):
+            if error is not None:
+                print("Image %s failed: %s" % (image.getId(), error))
+            else:
+                results.append((image.well_id, image.field, path))
+        files = aggregate_wells(results)
+    else:
+        pipeline = load_pipeline(pipeline_path)
+        files = analyze(plate, pipeline, ledger=ledger,
+                        all_fields=all_fields, rois=rois,
+                        tile_size=tile_size or None, cache=cache)
 
-    save_results(conn, files, plate)
-    disconnect(conn)
+    save_results(pool.conn, files, plate, pool=pool)
+    if ledger is not None:
+        ledger.set_uploaded(plate.getId())
+    pool.close()
     print("done")
 
 
@@ -24,10 +24,16 @@
 #
 # Version: 1.0
 #
+import json
 import os
+import queue
 import tempfile
+import threading
 import warnings
 
+import numpy
+
+from collections import namedtuple
 from getpass import getpass
 
 # Import OMERO Python BlitzGateway
@@ -72,35 +78,181 @@ def load_pipeline(pipeline_path):
     return pipeline
 
 
+# Prepare-pipeline
+class InjectPlane(InjectImage):
+    # InjectImage module whose plane is replaced for each Image
+    def __init__(self, image_name, channel):
+        super(InjectPlane, self).__init__(image_name, None)
+        self.channel = channel
+
+    def set_plane(self, plane):
+        self._InjectImage__image = plane
+
+
+def prepare_pipeline(pipeline, image_names=('OrigBlue', 'OrigGreen')):
+    # Add the modules injecting the planes once instead of copying
+    # the pipeline for each Image. Names of the channels expected
+    # in the pipeline, in the order of the Channels.
+    if any(isinstance(m, InjectPlane) for m in pipeline.modules()):
+        return pipeline
+    for c, image_name in enumerate(image_names):
+        inject_plane_module = InjectPlane(image_name, c)
+        inject_plane_module.set_module_num(1)
+        pipeline.add_module(inject_plane_module)
+    return pipeline
+
+
+def set_planes(pipeline, planes):
+    # Replace the planes injected in the prepared pipeline
+    for module in pipeline.modules():
+        if isinstance(module, InjectPlane):
+            module.set_plane(planes[module.channel])
+
+
+# Prefetch-planes
+# Pixels are sent by the server as big-endian bytes
+PIXEL_TYPES = {
+    'int8': '>i1', 'uint8': '>u1',
+    'int16': '>i2', 'uint16': '>u2',
+    'int32': '>i4', 'uint32': '>u4',
+    'float': '>f4', 'double': '>f8',
+}
+
+
+def load_planes(image, z=0, t=0):
+    # Load the planes of all Channels in a single call
+    # instead of one getPlane() call per Channel
+    conn = image._conn
+    pixels = image.getPrimaryPixels()
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    size_c = image.getSizeC()
+    store = conn.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels.getId(), True, conn.SERVICE_OPTS)
+        # offset, size and step are in XYZCT order
+        data = store.getHypercube([0, 0, z, 0, t],
+                                  [size_x, size_y, 1, size_c, 1],
+                                  [1, 1, 1, 1, 1], conn.SERVICE_OPTS)
+    finally:
+        store.close()
+    dtype = numpy.dtype(PIXEL_TYPES[pixels.getPixelsType().getValue()])
+    planes = numpy.frombuffer(data, dtype=dtype)
+    # Array of shape (c, y, x) in native byte order
+    planes = planes.reshape(size_c, size_y, size_x)
+    return planes.astype(dtype.newbyteorder('='))
+
+
+def prefetch(objects, load, depth=2):
+    # Download the data of the next objects in a background thread
+    # while the current one is analyzed. At most depth are kept in memory.
+    loaded = queue.Queue(maxsize=depth)
+    done = object()
+
+    def download():
+        try:
+            for obj in objects:
+                loaded.put((obj, load(obj)))
+        except Exception as e:
+            loaded.put((done, e))
+            return
+        loaded.put((done, None))
+
+    threading.Thread(target=download, daemon=True).start()
+    while True:
+        obj, data = loaded.get()
+        if obj is done:
+            if data is not None:
+                raise data
+            return
+        yield obj, data
+
+
+# Local-store
+class LocalImage(namedtuple('LocalImage', ['image_id', 'name', 'path'])):
+    # Image of the dataset saved in the local store
+    __slots__ = ()
+
+    def getId(self):
+        return self.image_id
+
+    def getName(self):
+        return self.name
+
+
+def read_index(directory):
+    path = os.path.join(directory, 'index.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def export_dataset(dataset, directory):
+    # Save the planes of each Image once, as a .npy file,
+    # so the pipeline can be tuned without downloading the Images again.
+    # Each dataset has its own directory in the store. Images added to
+    # the dataset are exported, Images removed are no longer analyzed.
+    # Returns the directory of the dataset.
+    directory = os.path.join(directory, str(dataset.getId()))
+    os.makedirs(directory, exist_ok=True)
+    index = read_index(directory)
+    exported = {}
+    if index is not None and index['dataset'] == dataset.getId():
+        exported = dict((entry['id'], entry) for entry in index['images'])
+    images = list(dataset.listChildren())
+    missing = [image for image in images if image.getId() not in exported]
+    if missing:
+        print("exporting %s images..." % len(missing))
+    for image, planes in prefetch(missing, load_planes):
+        path = '%s.npy' % image.getId()
+        numpy.save(os.path.join(directory, path), planes)
+        exported[image.getId()] = {'id': image.getId(),
+                                   'name': image.getName(), 'path': path}
+    index = {
+        'dataset': dataset.getId(),
+        'images': [exported[image.getId()] for image in images],
+    }
+    # Written then renamed, so an incomplete index is never read
+    tmp_path = os.path.join(directory, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(directory, 'index.json'))
+    return directory
+
+
+def load_local_images(directory):
+    # Planes are memory-mapped, only the pages used are read from disk
+    index = read_index(directory)
+    for entry in index['images']:
+        image = LocalImage(entry['id'], entry['name'], entry['path'])
+        planes = numpy.load(os.path.join(directory, image.path),
+                            mmap_mode='r')
+        yield image, planes
+
+
 # Analyze-data
-def analyze(dataset, pipeline):
+def analyze(dataset, pipeline, local_store=None):
     warnings.filterwarnings('ignore')
     print("analyzing...")
-    # Set Cell Output Directory
-    new_output_directory = os.path.normcase(tempfile.mkdtemp())
-    cpprefs.set_default_output_directory(new_output_directory)
+    prepare_pipeline(pipeline)
 
     files = list()
-    images = list(dataset.listChildren())
-    for count, image in enumerate(images):
+    if local_store is not None:
+        # The planes are read from the local store, not from the server
+        images_and_planes = load_local_images(local_store)
+    else:
+        images = list(dataset.listChildren())
+        # The planes of the next Images are downloaded during the analysis
+        images_and_planes = prefetch(images, load_planes)
+    for image, planes in images_and_planes:
         print(image.getName())
-        pixels = image.getPrimaryPixels()
-        size_c = image.getSizeC()
-        # For each Image in OMERO, we copy pipeline and inject image modules
-        pipeline_copy = pipeline.copy()
-        # Inject image for each Channel (pipeline only handles 2 channels)
-        for c in range(0, size_c):
-            plane = pixels.getPlane(0, c, 0)
-            image_name = image.getName()
-            # Name of the channel expected in the pipeline
-            if c == 0:
-                image_name = 'OrigBlue'
-            if c == 1:
-                image_name = 'OrigGreen'
-            inject_image_module = InjectImage(image_name, plane)
-            inject_image_module.set_module_num(1)
-            pipeline_copy.add_module(inject_image_module)
-        pipeline_copy.run()
+        # Set Cell Output Directory, one per Image so results are kept
+        new_output_directory = os.path.normcase(tempfile.mkdtemp())
+        cpprefs.set_default_output_directory(new_output_directory)
+        # For each Image in OMERO, we only replace the injected planes
+        set_planes(pipeline, planes)
+        pipeline.run()
 
         # Results obtained as CSV from Cell Profiler
         path = new_output_directory + '/Nuclei.csv'
@@ -132,6 +284,7 @@ def main():
     username = input("Username [trainer-1]: ") or 'trainer-1'
     password = getpass("Password: ")
     dataset_id = input("Dataset ID [1996]: ") or '1996'
+    local_store = input("Local store directory [none]: ") or None
     # Connect to the server
     conn = connect(host, username, password)
 
@@ -142,7 +295,11 @@ def main():
     # Load the dataset
     dataset = load_dataset(conn, dataset_id)
 
-    files = analyze(dataset, pipeline)
+    # The Images are downloaded only once into the local store
+    if local_store is not None:
+        local_store = export_dataset(dataset, local_store)
+
+    files = analyze(dataset, pipeline, local_store)
 
     save_results(conn, files, dataset)
     disconnect(conn)
@@ -25,13 +25,22 @@
 # Version: 1.0
 #
 import os
+import queue
 import tempfile
+import threading
 import warnings
 
+import numpy
+
+from concurrent.futures import ThreadPoolExecutor
+
 from getpass import getpass
 
 # Import OMERO Python BlitzGateway
 from omero.gateway import BlitzGateway
+from omero.model import FileAnnotationI, OriginalFileI
+from omero.model import ImageAnnotationLinkI, ImageI
+from omero.rtypes import rstring
 
 # Import Cell Profiler Dependencies
 import cellprofiler_core.preferences as cpprefs
@@ -72,52 +81,159 @@ def load_pipeline(pipeline_path):
     return pipeline
 
 
+# Prepare-pipeline
+class InjectPlane(InjectImage):
+    # InjectImage module whose plane is replaced for each Image
+    def __init__(self, image_name, channel):
+        super(InjectPlane, self).__init__(image_name, None)
+        self.channel = channel
+
+    def set_plane(self, plane):
+        self._InjectImage__image = plane
+
+
+def prepare_pipeline(pipeline, image_names=('OrigBlue', 'OrigGreen')):
+    # Add the modules injecting the planes once instead of copying
+    # the pipeline for each Image. Names of the channels expected
+    # in the pipeline, in the order of the Channels.
+    if any(isinstance(m, InjectPlane) for m in pipeline.modules()):
+        return pipeline
+    for c, image_name in enumerate(image_names):
+        inject_plane_module = InjectPlane(image_name, c)
+        inject_plane_module.set_module_num(1)
+        pipeline.add_module(inject_plane_module)
+    return pipeline
+
+
+def set_planes(pipeline, planes):
+    # Replace the planes injected in the prepared pipeline
+    for module in pipeline.modules():
+        if isinstance(module, InjectPlane):
+            module.set_plane(planes[module.channel])
+
+
+# Prefetch-planes
+# Pixels are sent by the server as big-endian bytes
+PIXEL_TYPES = {
+    'int8': '>i1', 'uint8': '>u1',
+    'int16': '>i2', 'uint16': '>u2',
+    'int32': '>i4', 'uint32': '>u4',
+    'float': '>f4', 'double': '>f8',
+}
+
+
+def load_planes(image, z=0, t=0):
+    # Load the planes of all Channels in a single call
+    # instead of one getPlane() call per Channel
+    conn = image._conn
+    pixels = image.getPrimaryPixels()
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    size_c = image.getSizeC()
+    store = conn.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels.getId(), True, conn.SERVICE_OPTS)
+        # offset, size and step are in XYZCT order
+        data = store.getHypercube([0, 0, z, 0, t],
+                                  [size_x, size_y, 1, size_c, 1],
+                                  [1, 1, 1, 1, 1], conn.SERVICE_OPTS)
+    finally:
+        store.close()
+    dtype = numpy.dtype(PIXEL_TYPES[pixels.getPixelsType().getValue()])
+    planes = numpy.frombuffer(data, dtype=dtype)
+    # Array of shape (c, y, x) in native byte order
+    planes = planes.reshape(size_c, size_y, size_x)
+    return planes.astype(dtype.newbyteorder('='))
+
+
+def list_fields(wells, all_fields=False):
+    # (Well, index) of the fields of all the acquisitions of each Well,
+    # or of the first field only
+    for well in wells:
+        count = well.countWellSample() if all_fields else 1
+        for index in range(count):
+            yield well, index
+
+
+def load_field(field):
+    well, index = field
+    image = well.getImage(index)
+    return image, load_planes(image)
+
+
+def prefetch(objects, load, depth=2):
+    # Download the data of the next objects in a background thread
+    # while the current one is analyzed. At most depth are kept in memory.
+    loaded = queue.Queue(maxsize=depth)
+    done = object()
+
+    def download():
+        try:
+            for obj in objects:
+                loaded.put((obj, load(obj)))
+        except Exception as e:
+            loaded.put((done, e))
+            return
+        loaded.put((done, None))
+
+    threading.Thread(target=download, daemon=True).start()
+    while True:
+        obj, data = loaded.get()
+        if obj is done:
+            if data is not None:
+                raise data
+            return
+        yield obj, data
+
+
 # Analyze-data
-def analyze(conn, plate, pipeline):
+def analyze(conn, plate, pipeline, all_fields=False):
     warnings.filterwarnings('ignore')
     print("analyzing...")
-    # Set Cell Output Directory
-    new_output_directory = os.path.normcase(tempfile.mkdtemp())
-    cpprefs.set_default_output_directory(new_output_directory)
+    prepare_pipeline(pipeline)
 
+    results = list()
     wells = list(plate.listChildren())
     wells = wells[0:5]  # use the first 5 wells
-    for count, well in enumerate(wells):
-        # Load a single Image per Well
-        image = well.getImage(0)
+    # The planes of the next fields are downloaded during the analysis.
+    # Results are linked to the Image of each field.
+    fields = list_fields(wells, all_fields)
+    for field, (image, planes) in prefetch(fields, load_field):
         print(image.getName())
-        pixels = image.getPrimaryPixels()
-        size_c = image.getSizeC()
-        # For each Image in OMERO, we copy pipeline and inject image modules
-        pipeline_copy = pipeline.copy()
-        # Inject image for each Channel (pipeline only handles 2 channels)
-        for c in range(0, size_c):
-            plane = pixels.getPlane(0, c, 0)
-            image_name = image.getName()
-            # Name of the channel expected in the pipeline
-            if c == 0:
-                image_name = 'OrigBlue'
-            if c == 1:
-                image_name = 'OrigGreen'
-            inject_image_module = InjectImage(image_name, plane)
-            inject_image_module.set_module_num(1)
-            pipeline_copy.add_module(inject_image_module)
-        pipeline_copy.run()
+        # Set Cell Output Directory, one per Image so results are kept
+        new_output_directory = os.path.normcase(tempfile.mkdtemp())
+        cpprefs.set_default_output_directory(new_output_directory)
+        # For each Image in OMERO, we only replace the injected planes
+        set_planes(pipeline, planes)
+        pipeline.run()
 
         # Results obtained as CSV from Cell Profiler
         path = new_output_directory + '/Nuclei.csv'
-        save_results(conn, path, image)
+        results.append((path, image))
+    save_results(conn, results)
     print("analysis done")
 
 
 # Save-results
-def save_results(conn, f, image):
-    # Upload the CSV files
+def save_results(conn, results, workers=4):
+    # Upload the CSV files in parallel
     print("saving results...")
     namespace = "cellprofiler.demo.namespace"
-    ann = conn.createFileAnnfromLocalFile(f, mimetype="text/csv",
-                                          ns=namespace, desc=None)
-    image.linkAnnotation(ann)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        orig_files = list(executor.map(
+            lambda result: conn.createOriginalFileFromLocalFile(
+                result[0], mimetype="text/csv"), results))
+    # Create all the annotations and the links to the images in one call
+    links = []
+    for orig_file, (f, image) in zip(orig_files, results):
+        ann = FileAnnotationI()
+        ann.setFile(OriginalFileI(orig_file.getId(), False))
+        ann.setNs(rstring(namespace))
+        link = ImageAnnotationLinkI()
+        link.setParent(ImageI(image.getId(), False))
+        link.setChild(ann)
+        links.append(link)
+    conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
 
 
 # Disconnect
@@ -132,6 +248,7 @@ def main():
     username = input("Username [trainer-1]: ") or 'trainer-1'
     password = getpass("Password: ")
     plate_id = input("Plate ID [102]: ") or '102'
+    all_fields = (input("Analyze all fields [no]: ") or 'no') == 'yes'
     # Connect to the server
     conn = connect(host, username, password)
 
@@ -142,7 +259,7 @@ def main():
     # Load the plate
     plate = load_plate(conn, plate_id)
 
-    analyze(conn, plate, pipeline)
+    analyze(conn, plate, pipeline, all_fields)
 
     disconnect(conn)
     print("done")
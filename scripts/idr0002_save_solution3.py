@@ -25,15 +25,23 @@
 # Version: 1.0
 #
 import os
+import queue
 import tempfile
+import threading
 import warnings
+import zipfile
+
+import numpy
 import pandas
+import pyarrow
+import pyarrow.parquet
 
 from getpass import getpass
 
 # Import OMERO Python BlitzGateway
 from omero.gateway import BlitzGateway
-from omero.grid import DoubleColumn, ImageColumn, LongColumn, WellColumn
+from omero.grid import BoolColumn, DoubleColumn, FloatColumn, ImageColumn
+from omero.grid import LongColumn, WellColumn
 from omero.constants.namespaces import NSBULKANNOTATIONS
 from omero.gateway import FileAnnotationWrapper
 from omero.model import OriginalFileI
@@ -77,83 +85,358 @@ def load_pipeline(pipeline_path):
     return pipeline
 
 
+# Prepare-pipeline
+class InjectPlane(InjectImage):
+    # InjectImage module whose plane is replaced for each Image
+    def __init__(self, image_name, channel):
+        super(InjectPlane, self).__init__(image_name, None)
+        self.channel = channel
+
+    def set_plane(self, plane):
+        self._InjectImage__image = plane
+
+
+def prepare_pipeline(pipeline, image_names=('OrigBlue', 'OrigGreen')):
+    # Add the modules injecting the planes once instead of copying
+    # the pipeline for each Image. Names of the channels expected
+    # in the pipeline, in the order of the Channels.
+    if any(isinstance(m, InjectPlane) for m in pipeline.modules()):
+        return pipeline
+    for c, image_name in enumerate(image_names):
+        inject_plane_module = InjectPlane(image_name, c)
+        inject_plane_module.set_module_num(1)
+        pipeline.add_module(inject_plane_module)
+    return pipeline
+
+
+def set_planes(pipeline, planes):
+    # Replace the planes injected in the prepared pipeline
+    for module in pipeline.modules():
+        if isinstance(module, InjectPlane):
+            module.set_plane(planes[module.channel])
+
+
+# Prefetch-planes
+# Pixels are sent by the server as big-endian bytes
+PIXEL_TYPES = {
+    'int8': '>i1', 'uint8': '>u1',
+    'int16': '>i2', 'uint16': '>u2',
+    'int32': '>i4', 'uint32': '>u4',
+    'float': '>f4', 'double': '>f8',
+}
+
+
+def load_planes(image, z=0, t=0):
+    # Load the planes of all Channels in a single call
+    # instead of one getPlane() call per Channel
+    conn = image._conn
+    pixels = image.getPrimaryPixels()
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    size_c = image.getSizeC()
+    store = conn.createRawPixelsStore()
+    try:
+        store.setPixelsId(pixels.getId(), True, conn.SERVICE_OPTS)
+        # offset, size and step are in XYZCT order
+        data = store.getHypercube([0, 0, z, 0, t],
+                                  [size_x, size_y, 1, size_c, 1],
+                                  [1, 1, 1, 1, 1], conn.SERVICE_OPTS)
+    finally:
+        store.close()
+    dtype = numpy.dtype(PIXEL_TYPES[pixels.getPixelsType().getValue()])
+    planes = numpy.frombuffer(data, dtype=dtype)
+    # Array of shape (c, y, x) in native byte order
+    planes = planes.reshape(size_c, size_y, size_x)
+    return planes.astype(dtype.newbyteorder('='))
+
+
+def list_fields(wells, all_fields=False):
+    # (Well, index) of the fields of all the acquisitions of each Well,
+    # or of the first field only
+    for well in wells:
+        count = well.countWellSample() if all_fields else 1
+        for index in range(count):
+            yield well, index
+
+
+def load_field(field):
+    well, index = field
+    image = well.getImage(index)
+    return image, load_planes(image)
+
+
+def prefetch(objects, load, depth=2):
+    # Download the data of the next objects in a background thread
+    # while the current one is analyzed. At most depth are kept in memory.
+    loaded = queue.Queue(maxsize=depth)
+    done = object()
+
+    def download():
+        try:
+            for obj in objects:
+                loaded.put((obj, load(obj)))
+        except Exception as e:
+            loaded.put((done, e))
+            return
+        loaded.put((done, None))
+
+    threading.Thread(target=download, daemon=True).start()
+    while True:
+        obj, data = loaded.get()
+        if obj is done:
+            if data is not None:
+                raise data
+            return
+        yield obj, data
+
+
+# Read-measurements
+def remove_export(pipeline):
+    # Measurements are read from the pipeline, no CSV file is written
+    for module in list(pipeline.modules()):
+        if module.module_name == 'ExportToSpreadsheet':
+            pipeline.remove_module(module.module_num)
+    return pipeline
+
+
+def read_measurements(measurements, object_name):
+    # One column per feature and one row per object,
+    # or a single row for the 'Image' measurements
+    columns = {}
+    for feature in measurements.get_feature_names(object_name):
+        values = measurements.get_measurement(object_name, feature)
+        if values is not None:
+            columns[feature] = numpy.atleast_1d(values)
+    return pandas.DataFrame(columns)
+
+
 # Analyze-data
-def analyze(plate, pipeline):
+def analyze(plate, pipeline, all_fields=False):
     warnings.filterwarnings('ignore')
     print("analyzing...")
+    prepare_pipeline(pipeline)
+    remove_export(pipeline)
     # Set Cell Output Directory
     new_output_directory = os.path.normcase(tempfile.mkdtemp())
     cpprefs.set_default_output_directory(new_output_directory)
 
-    files = list()
     wells = list(plate.listChildren())
     wells = wells[0:5]  # use the first 5 wells
-    for count, well in enumerate(wells):
-        # Load a single Image per Well
-        image = well.getImage(0)
+    # The planes of the next fields are downloaded during the analysis
+    fields = list_fields(wells, all_fields)
+    frames = []
+    image_frames = []
+    well_id = None
+    for (well, index), (image, planes) in prefetch(fields, load_field):
+        if frames and well.getId() != well_id:
+            # Results are returned as soon as each Well is done
+            yield (pandas.concat(frames, ignore_index=True),
+                   pandas.concat(image_frames, ignore_index=True))
+            frames = []
+            image_frames = []
+        well_id = well.getId()
         print(image.getName())
-        pixels = image.getPrimaryPixels()
-        size_c = image.getSizeC()
-        # For each Image in OMERO, we copy pipeline and inject image modules
-        pipeline_copy = pipeline.copy()
-        # Inject image for each Channel (pipeline only handles 2 channels)
-        for c in range(0, size_c):
-            plane = pixels.getPlane(0, c, 0)
-            image_name = image.getName()
-            # Name of the channel expected in the pipeline
-            if c == 0:
-                image_name = 'OrigBlue'
-            if c == 1:
-                image_name = 'OrigGreen'
-            inject_image_module = InjectImage(image_name, plane)
-            inject_image_module.set_module_num(1)
-            pipeline_copy.add_module(inject_image_module)
-        pipeline_copy.run()
-
-        # Results obtained as CSV from Cell Profiler
-        path = new_output_directory + '/Nuclei.csv'
-        f = pandas.read_csv(path, index_col=None, header=0)
+        # For each Image in OMERO, we only replace the injected planes
+        set_planes(pipeline, planes)
+        measurements = pipeline.run()
+
+        # Results read from the measurements of Cell Profiler
+        f = read_measurements(measurements, 'Nuclei')
         f['Image'] = image.getId()
         f['Well'] = well.getId()
+        f['Field'] = index
         f['Cell_Count'] = len(f.index)
-        files.append(f)
+        frames.append(f)
+        # One row of Image measurements, e.g. Count_Nuclei
+        # and the percentage of PH3 positive cells
+        i = read_measurements(measurements, 'Image')
+        i['Image'] = image.getId()
+        i['Well'] = well.getId()
+        i['Field'] = index
+        image_frames.append(i)
+    if frames:
+        yield (pandas.concat(frames, ignore_index=True),
+               pandas.concat(image_frames, ignore_index=True))
     print("analysis done")
-    return files
 
 
 # Save-results
-def save_results(conn, files, plate):
-    # Upload the results as OMERO.table
-    print("saving results...")
-    Nuclei = pandas.concat(files, ignore_index=True)
-    summary = Nuclei.groupby('Image').mean()
-    # Free memory
-    del Nuclei
+def create_columns(frame):
+    # Type of the column from the dtype of the data.
+    # There is no 32-bit integer column, integers are saved as LongColumn
     cols = []
-    for col in summary.columns:
+    for col in frame.columns:
+        kind = frame[col].dtype.kind
         if col == 'Image':
-            cols.append(ImageColumn(col, '', summary[col]))
+            cols.append(ImageColumn(col, '', []))
         elif col == 'Well':
-            cols.append(WellColumn(col, '', summary[col]))
-        elif summary[col].dtype == 'int64':
-            cols.append(LongColumn(col, '', summary[col]))
-        elif summary[col].dtype == 'float64':
-            cols.append(DoubleColumn(col, '', summary[col]))
-    resources = conn.c.sf.sharedResources()
-    repository_id = resources.repositories().descriptions[0].getId().getValue()
-    table_name = "idr0002_cellprofiler"
-    table = resources.newTable(repository_id, table_name)
-    table.initialize(cols)
-    table.addData(cols)
-
-    # Link the table to the plate
-    orig_file = table.getOriginalFile()
-    file_ann = FileAnnotationWrapper(conn)
-    file_ann.setNs(NSBULKANNOTATIONS)
-    file_ann._obj.file = OriginalFileI(orig_file.id.val, False)
-    file_ann.save()
+            cols.append(WellColumn(col, '', []))
+        elif kind == 'b':
+            cols.append(BoolColumn(col, '', []))
+        elif kind in 'iu':
+            cols.append(LongColumn(col, '', []))
+        elif frame[col].dtype == 'float32':
+            cols.append(FloatColumn(col, '', []))
+        elif kind == 'f':
+            cols.append(DoubleColumn(col, '', []))
+    return cols
+
+
+class TableWriter(object):
+    # Add the rows to an OMERO.table in batches of batch_size rows,
+    # so the results of the whole plate are never kept in memory
+
+    def __init__(self, conn, plate, table_name, batch_size):
+        self.conn = conn
+        self.plate = plate
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.table = None
+        self.cols = None
+        self.rows = []
+        self.row_count = 0
+
+    def create_table(self, frame):
+        self.cols = create_columns(frame)
+        resources = self.conn.c.sf.sharedResources()
+        repository_id = resources.repositories().descriptions[0].getId().getValue()
+        self.table = resources.newTable(repository_id, self.table_name)
+        self.table.initialize(self.cols)
+
+        # Link the table to the plate
+        # before adding the rows, so the rows added are kept if the run fails
+        orig_file = self.table.getOriginalFile()
+        file_ann = FileAnnotationWrapper(self.conn)
+        file_ann.setNs(NSBULKANNOTATIONS)
+        file_ann._obj.file = OriginalFileI(orig_file.id.val, False)
+        file_ann.save()
+        self.plate.linkAnnotation(file_ann)
+
+    def append(self, frame):
+        if self.table is None:
+            self.create_table(frame)
+        self.rows.append(frame)
+        self.row_count += len(frame.index)
+        if self.row_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        batch = pandas.concat(self.rows, ignore_index=True)
+        for col in self.cols:
+            col.values = batch[col.name].tolist()
+        self.table.addData(self.cols)
+        self.rows = []
+        self.row_count = 0
+
+    def close(self):
+        if self.table is not None:
+            self.flush()
+            self.table.close()
+
+
+def save_results(conn, files, plate, batch_size=10000,
+                 parquet_directory=None):
+    # Upload the results as OMERO.tables: one row per Image,
+    # with the Image measurements and the mean of the Nuclei measurements,
+    # and one row per Nuclei
+    print("saving results...")
+    summary_table = TableWriter(conn, plate, "idr0002_cellprofiler",
+                                batch_size)
+    nuclei_table = TableWriter(conn, plate, "idr0002_cellprofiler_nuclei",
+                               batch_size)
+    summary_writers = [summary_table]
+    nuclei_writers = [nuclei_table]
+    if parquet_directory is not None:
+        # The same rows are also written as Parquet files
+        summary_writers.append(ParquetWriter(parquet_directory, plate,
+                                             "summary"))
+        nuclei_writers.append(ParquetWriter(parquet_directory, plate,
+                                            "nuclei"))
+    try:
+        for Nuclei, Images in files:
+            means = Nuclei.drop(columns=['Well', 'Field'])
+            means = means.groupby('Image', as_index=False).mean()
+            summary = Images.merge(means, on='Image', how='left',
+                                   suffixes=('', '_Mean'))
+            summary = summary.astype({'Image': 'int64', 'Well': 'int64'})
+            for writer in summary_writers:
+                writer.append(summary)
+            for writer in nuclei_writers:
+                writer.append(Nuclei)
+    finally:
+        summary_table.close()
+        nuclei_table.close()
+    if parquet_directory is not None:
+        attach_parquet(conn, parquet_directory, plate)
+
+
+# Save-parquet
+def compact_types(frame):
+    # Measurements fit in 32 bits, only the OMERO IDs are kept as int64.
+    # The types do not depend on the values, so all the files of
+    # a dataset have the same schema
+    types = {}
+    for col in frame.columns:
+        kind = frame[col].dtype.kind
+        if col in ('Image', 'Well'):
+            continue
+        elif kind == 'f':
+            types[col] = 'float32'
+        elif kind in 'iu':
+            types[col] = 'int32'
+    return frame.astype(types)
+
+
+class ParquetWriter(object):
+    # Write the rows of each Well as soon as it is analyzed, in a dataset
+    # partitioned as <name>/plate=<id>/well=<id>/ so the readers only
+    # open the files of the Wells they select
+
+    def __init__(self, directory, plate, name):
+        self.directory = directory
+        self.plate = plate
+        self.name = name
+        self.schema = None
+
+    def append(self, frame):
+        if frame.empty:
+            return
+        well_id = int(frame['Well'].iloc[0])
+        # The Well is given by the partition
+        frame = compact_types(frame.drop(columns='Well'))
+        table = pyarrow.Table.from_pandas(frame, schema=self.schema,
+                                          preserve_index=False)
+        self.schema = table.schema
+        path = os.path.join(self.directory, self.name,
+                            'plate=%s' % self.plate.getId(),
+                            'well=%s' % well_id)
+        os.makedirs(path, exist_ok=True)
+        # The min and max of each column are saved with each row group,
+        # rows are skipped by filters without being read
+        pyarrow.parquet.write_table(table,
+                                    os.path.join(path, 'part-0.parquet'),
+                                    compression='zstd',
+                                    row_group_size=65536,
+                                    write_statistics=True)
+
+
+def attach_parquet(conn, directory, plate):
+    # The dataset is linked to the plate as a single zip file.
+    # Parquet files are already compressed, so they are only stored
+    path = os.path.normpath(directory) + '.zip'
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+        for root, _, names in os.walk(directory):
+            for name in names:
+                full_path = os.path.join(root, name)
+                archive.write(full_path, os.path.relpath(full_path,
+                                                         directory))
+    namespace = "cellprofiler.demo.namespace"
+    file_ann = conn.createFileAnnfromLocalFile(path,
+                                               mimetype="application/zip",
+                                               ns=namespace, desc=None)
     plate.linkAnnotation(file_ann)
-    table.close()
 
 
 # Disconnect
@@ -168,6 +451,8 @@ def main():
     username = input("Username [trainer-1]: ") or 'trainer-1'
     password = getpass("Password: ")
     plate_id = input("Plate ID [102]: ") or '102'
+    all_fields = (input("Analyze all fields [no]: ") or 'no') == 'yes'
+    parquet_directory = input("Parquet directory [none]: ") or None
     # Connect to the server
     conn = connect(host, username, password)
 
@@ -178,9 +463,9 @@ def main():
     # Load the plate
     plate = load_plate(conn, plate_id)
 
-    files = analyze(plate, pipeline)
+    files = analyze(plate, pipeline, all_fields)
 
-    save_results(conn, files, plate)
+    save_results(conn, files, plate, parquet_directory=parquet_directory)
     disconnect(conn)
     print("done")
 